@@ -1,6 +1,9 @@
 # app.py — FRETE com DISTÂNCIA REAL entre CEPs + Regras por Município + XML Tray + BUSCA DE ENDEREÇO
-import os, math, re, time, requests, html
-from typing import Dict, Any, List, Tuple, Optional
+import os, math, re, time, requests, html, gc
+from array import array
+from bisect import bisect_left
+from typing import Dict, Any, List, Tuple, Optional, Iterator
+import numpy as np
 import pandas as pd
 from flask import Flask, request, Response, make_response
 from functools import lru_cache
@@ -9,12 +12,23 @@ from functools import lru_cache
 # CONFIG
 # ==========================
 TOKEN_SECRETO = os.getenv("TOKEN_SECRETO", "teste123")
-CEP_ORIGEM    = os.getenv("CEP_ORIGEM", "98400000")  # Frederico Westphalen/RS
+CEP_ORIGEM    = os.getenv("CEP_ORIGEM", "98400000")  # Frederico Westphalen/RS (depósito padrão)
+# Escolha do depósito quando a planilha tem aba DEPOSITOS: "menor_custo" ou "mais_proximo"
+DEPOSITO_CRITERIO = os.getenv("DEPOSITO_CRITERIO", "menor_custo").strip().lower()
+# Coordenadas fixas do depósito padrão (CEP_ORIGEM); sem elas o CEP é geocodificado no 1º uso
+CEP_ORIGEM_LAT = os.getenv("CEP_ORIGEM_LAT", "").strip()
+CEP_ORIGEM_LON = os.getenv("CEP_ORIGEM_LON", "").strip()
+DEPOSITO_RETRY_S = float(os.getenv("DEPOSITO_RETRY_S", "300"))  # espera p/ tentar de novo um depósito sem coordenadas
 ARQ_PLANILHA  = os.getenv("PLANILHA_FRETE", "tabela de frete atualizada(2)(Recuperado Automaticamente).xlsx")
 
 DEFAULT_VALOR_KM     = float(os.getenv("DEFAULT_VALOR_KM", "7.0"))
 DEFAULT_TAM_CAMINHAO = float(os.getenv("DEFAULT_TAM_CAMINHAO", "8.5"))
 DEFAULT_KM           = float(os.getenv("DEFAULT_KM", "450.0"))
+# Teto do parâmetro 'prods' (já decodificado). O limite que vale antes é o da linha de
+# requisição: 8190 bytes no gunicorn (--limit-request-line no Procfile, máximo permitido)
+# e 8 KB no roteador do Heroku; por isso o padrão fica abaixo disso.
+MAX_PRODS_CHARS      = int(os.getenv("MAX_PRODS_CHARS", "8000"))
+XML_CHUNK_BYTES      = 16 * 1024  # tamanho aproximado de cada pedaço do XML em streaming
 
 # (Opcional) Provedor com token próprio (pago/privado)
 API_CEP_URL   = os.getenv("API_CEP_URL", "").strip()    # ex.: https://api.suaempresa.com/cep/{cep}
@@ -47,26 +61,31 @@ def so_digitos(cep: Any) -> str:
     s = re.sub(r"\D","", str(cep or ""))
     return s[:8] if len(s) >= 8 else s.zfill(8)
 
+UF_CEP_RANGES = (
+    ("SP","01000000","19999999"),("RJ","20000000","28999999"),
+    ("ES","29000000","29999999"),("MG","30000000","39999999"),
+    ("BA","40000000","48999999"),("SE","49000000","49999999"),
+    ("PE","50000000","56999999"),("AL","57000000","57999999"),
+    ("PB","58000000","58999999"),("RN","59000000","59999999"),
+    ("CE","60000000","63999999"),("PI","64000000","64999999"),
+    ("MA","65000000","65999999"),("PA","66000000","68899999"),
+    ("AP","68900000","68999999"),("AM","69000000","69899999"),
+    ("RR","69300000","69399999"),("AC","69900000","69999999"),
+    ("DF","70000000","73699999"),("GO","72800000","76799999"),
+    ("TO","77000000","77999999"),("MT","78000000","78899999"),
+    ("MS","79000000","79999999"),("PR","80000000","87999999"),
+    ("SC","88000000","89999999"),("RS","90000000","99999999"),
+)
+# Índice de faixas já convertido p/ inteiros (montado uma vez, compartilhado entre workers)
+_UF_CEP_UF  = tuple(uf for uf, _, _ in UF_CEP_RANGES)
+_UF_CEP_INI = array("l", (int(a) for _, a, _ in UF_CEP_RANGES))
+_UF_CEP_FIM = array("l", (int(b) for _, _, b in UF_CEP_RANGES))
+
 def uf_por_cep(cep8: str) -> Optional[str]:
-    UF_CEP_RANGES = [
-        ("SP","01000000","19999999"),("RJ","20000000","28999999"),
-        ("ES","29000000","29999999"),("MG","30000000","39999999"),
-        ("BA","40000000","48999999"),("SE","49000000","49999999"),
-        ("PE","50000000","56999999"),("AL","57000000","57999999"),
-        ("PB","58000000","58999999"),("RN","59000000","59999999"),
-        ("CE","60000000","63999999"),("PI","64000000","64999999"),
-        ("MA","65000000","65999999"),("PA","66000000","68899999"),
-        ("AP","68900000","68999999"),("AM","69000000","69899999"),
-        ("RR","69300000","69399999"),("AC","69900000","69999999"),
-        ("DF","70000000","73699999"),("GO","72800000","76799999"),
-        ("TO","77000000","77999999"),("MT","78000000","78899999"),
-        ("MS","79000000","79999999"),("PR","80000000","87999999"),
-        ("SC","88000000","89999999"),("RS","90000000","99999999"),
-    ]
     try: n = int(cep8)
     except: return None
-    for uf, a, b in UF_CEP_RANGES:
-        if int(a) <= n <= int(b): return uf
+    for i in range(len(_UF_CEP_UF)):
+        if _UF_CEP_INI[i] <= n <= _UF_CEP_FIM[i]: return _UF_CEP_UF[i]
     return None
 
 def extrai_numero_linha(row) -> Optional[float]:
@@ -93,6 +112,36 @@ def _request_json(url: str, timeout: int = 5, retries: int = 2, headers: Optiona
             time.sleep(0.25 * (i+1))
     return None
 
+def memoria_processo() -> Dict[str, int]:
+    """
+    Memória do processo atual em kB. Em Linux usa /proc/self/smaps_rollup, que
+    separa o que é compartilhado com o master (Shared_*) do que é do worker
+    (Private_*); Pss divide as páginas compartilhadas entre quem as usa.
+    """
+    campos = ("Rss", "Pss", "Shared_Clean", "Shared_Dirty", "Private_Clean", "Private_Dirty")
+    out: Dict[str, int] = {}
+    try:
+        with open("/proc/self/smaps_rollup") as f:
+            for linha in f:
+                chave, _, resto = linha.partition(":")
+                if chave in campos:
+                    out[chave.lower()] = int(resto.split()[0])
+        if out: return out
+    except Exception:
+        pass
+    try:
+        with open("/proc/self/status") as f:
+            for linha in f:
+                if linha.startswith("VmRSS:"):
+                    return {"rss": int(linha.split()[1])}
+    except Exception:
+        pass
+    try:
+        import resource
+        return {"rss_max": int(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)}
+    except Exception:
+        return {}
+
 # ==========================
 # BUSCA DE ENDEREÇO (GRÁTIS + OPCIONAL COM TOKEN)
 # ==========================
@@ -282,7 +331,109 @@ def haversine(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
     c = 2.0 * math.atan2(math.sqrt(a), math.sqrt(1.0 - a))
     return R * c
 
-def calcular_distancia_ceps(cep_origem: str, cep_destino: str) -> Tuple[Optional[float], str]:
+def haversine_vet(lat: float, lon: float, lats: np.ndarray, lons: np.ndarray) -> np.ndarray:
+    """Distância (km) de um ponto para N pontos de uma vez; NaN onde faltar coordenada."""
+    R = 6371.0
+    lat1 = math.radians(lat)
+    lat2 = np.radians(lats)
+    dlat = lat2 - lat1
+    dlon = np.radians(lons) - math.radians(lon)
+    a = np.sin(dlat/2.0)**2 + math.cos(lat1)*np.cos(lat2)*np.sin(dlon/2.0)**2
+    return R * 2.0 * np.arctan2(np.sqrt(a), np.sqrt(1.0 - a))
+
+# Por worker: lat/lon dos depósitos completadas pelo CEP quando a planilha/env não trazem
+_coords_depositos: Optional[Tuple[np.ndarray, np.ndarray]] = None
+_proxima_tentativa: Dict[int, float] = {}
+
+def _coordenadas_deposito(cep8: str) -> Optional[Tuple[float, float]]:
+    """Como buscar_coordenadas, mas sem guardar falha: a próxima chamada tenta de novo."""
+    if cep8 in cache_coords: return cache_coords[cep8]
+    cache_cep_info.pop(cep8, None)
+    info = buscar_info_cep.__wrapped__(cep8) or {}
+    loc = info.get("location")
+    if loc: return (loc["lat"], loc["lon"])
+    cache_cep_info.pop(cep8, None)
+    return None
+
+def coordenadas_depositos() -> Tuple[np.ndarray, np.ndarray]:
+    """
+    lat/lon de todos os depósitos. Sem faltantes, devolve os arrays compartilhados.
+    Faltantes são geocodificados aqui, no worker (nunca no import); falhas ficam
+    NaN e são tentadas de novo após DEPOSITO_RETRY_S.
+    """
+    global _coords_depositos
+    deps: Depositos = DATA["depositos"]
+    if _coords_depositos is None:
+        _coords_depositos = (deps.lat, deps.lon)
+    lat, lon = _coords_depositos
+    faltando = np.flatnonzero(np.isnan(lat) | np.isnan(lon))
+    if not len(faltando): return lat, lon
+
+    agora = time.monotonic()
+    pendentes = [int(i) for i in faltando if _proxima_tentativa.get(int(i), 0.0) <= agora]
+    if not pendentes: return lat, lon
+    if lat is deps.lat:
+        lat = lat.copy(); lon = lon.copy()
+    for i in pendentes:
+        c = _coordenadas_deposito(deps.cep[i])
+        if c:
+            lat[i], lon[i] = c
+            _proxima_tentativa.pop(i, None)
+        else:
+            _proxima_tentativa[i] = agora + DEPOSITO_RETRY_S
+            print(f"[WARN] Depósito {deps.nome[i]} ({deps.cep[i]}) sem coordenadas; nova tentativa em {DEPOSITO_RETRY_S:.0f}s")
+    _coords_depositos = (lat, lon)
+    return lat, lon
+
+def escolher_deposito(coord_destino: Tuple[float, float],
+                      valor_km: Optional[float] = None,
+                      tam_caminhao: Optional[float] = None) -> Tuple[Optional[int], Optional[float]]:
+    """
+    Calcula a distância do destino a todos os depósitos num único passo vetorizado
+    e devolve (índice, km) do escolhido. Em "menor_custo" o critério é
+    km * VALOR_KM / TAM_CAMINHAO de cada depósito (o custo do item é proporcional
+    a isso); valor_km/tam_caminhao informados valem p/ todos os depósitos.
+    """
+    deps: Depositos = DATA["depositos"]
+    if not len(deps): return (None, None)
+    lats, lons = coordenadas_depositos()
+    km = haversine_vet(coord_destino[0], coord_destino[1], lats, lons)
+    if np.isnan(km).all(): return (None, None)
+
+    if DEPOSITO_CRITERIO == "mais_proximo":
+        score = km
+    else:
+        consts = DATA["consts"]
+        vk = np.full(len(deps), valor_km) if valor_km else \
+             np.where(deps.valor_km > 0, deps.valor_km, consts.get("VALOR_KM", DEFAULT_VALOR_KM))
+        tc = np.full(len(deps), tam_caminhao) if tam_caminhao else \
+             np.where(deps.tam_caminhao > 0, deps.tam_caminhao, consts.get("TAM_CAMINHAO", DEFAULT_TAM_CAMINHAO))
+        score = km * vk / tc
+    if np.isnan(score).all(): return (None, None)
+    i = int(np.nanargmin(score))
+    return (i, round(float(km[i]), 1))
+
+def distancia_por_deposito(cep_destino: str,
+                           valor_km: Optional[float] = None,
+                           tam_caminhao: Optional[float] = None) -> Tuple[Optional[int], Optional[float], str]:
+    """
+    (índice do depósito, km, fonte). Sem coordenadas do destino o km sai da tabela
+    KM_APROX_POR_UF, medida a partir de CEP_ORIGEM; por isso o depósito devolvido é
+    o de CEP_ORIGEM (None se ele não estiver cadastrado).
+    """
+    coord_destino = buscar_coordenadas(cep_destino)
+    if coord_destino:
+        i, km = escolher_deposito(coord_destino, valor_km, tam_caminhao)
+        if i is not None:
+            return (i, km, "distancia_real")
+    i_origem = DATA["depositos"].i_origem
+    return (i_origem if i_origem >= 0 else None, None, "erro_coordenadas")
+
+def calcular_distancia_ceps(cep_origem: Optional[str], cep_destino: str) -> Tuple[Optional[float], str]:
+    """Sem cep_origem, mede a partir do melhor depósito cadastrado."""
+    if not cep_origem:
+        _, km, fonte = distancia_por_deposito(cep_destino)
+        return (km, fonte)
     coord_origem = buscar_coordenadas(cep_origem)
     coord_destino = buscar_coordenadas(cep_destino)
     if coord_origem and coord_destino:
@@ -358,6 +509,32 @@ def montar_catalogo_tamanho(df: pd.DataFrame) -> Dict[str, float]:
         except: pass
     return mapa
 
+class Catalogo:
+    """
+    Catálogo nome -> tamanho (m) imutável e compacto: nomes ordenados numa tupla
+    e tamanhos num array('d'), busca por bisect. Só reduz o número de objetos;
+    quem mantém as páginas compartilhadas após o fork é o gc.freeze() do carregamento
+    (as buscas ainda mexem no refcount de alguns nomes).
+    """
+    __slots__ = ("_nomes", "_tam")
+
+    def __init__(self, mapa: Dict[str, float]):
+        nomes = sorted(mapa)
+        self._nomes: Tuple[str, ...] = tuple(nomes)
+        self._tam = array("d", (float(mapa[n]) for n in nomes))
+
+    def get(self, nome: str, default: Optional[float] = None) -> Optional[float]:
+        i = bisect_left(self._nomes, nome)
+        if i < len(self._nomes) and self._nomes[i] == nome:
+            return self._tam[i]
+        return default
+
+    def __contains__(self, nome: str) -> bool:
+        return self.get(nome) is not None
+
+    def __len__(self) -> int:
+        return len(self._nomes)
+
 def carregar_regras_municipio(xls: pd.ExcelFile) -> List[Dict[str, Any]]:
     """
     Lê aba REGRAS_MUNICIPIO (opcional) com colunas:
@@ -388,70 +565,196 @@ def carregar_regras_municipio(xls: pd.ExcelFile) -> List[Dict[str, Any]]:
         print(f"[WARN] Falha ao ler REGRAS_MUNICIPIO: {e}")
         return []
 
-def regra_cobre_cep(reg: Dict[str, Any], cep8: str) -> bool:
-    if reg.get("cep_ini") and reg.get("cep_fim"):
-        try:
-            n = int(cep8); a = int(reg["cep_ini"]); b = int(reg["cep_fim"])
-            return a <= n <= b
-        except: return False
-    return False
+class RegrasMunicipio:
+    """
+    Regras por município em colunas (arrays/tuplas) em vez de lista de dicts.
+    Faixas de CEP já convertidas p/ inteiro (-1 = sem faixa).
+    """
+    __slots__ = ("municipio", "uf", "cep_ini", "cep_fim",
+                 "km_fixo", "mult_valor_km", "valor_min", "acrescimo_fixo")
+
+    def __init__(self, regras: List[Dict[str, Any]]):
+        def faixa(v: str) -> int:
+            try: return int(v) if v else -1
+            except: return -1
+        self.municipio: Tuple[str, ...] = tuple((r.get("municipio") or "").strip().upper() for r in regras)
+        self.uf: Tuple[str, ...]        = tuple((r.get("uf") or "").strip().upper() for r in regras)
+        self.cep_ini        = array("l", (faixa(r.get("cep_ini")) for r in regras))
+        self.cep_fim        = array("l", (faixa(r.get("cep_fim")) for r in regras))
+        self.km_fixo        = array("d", (float(r.get("km_fixo", 0) or 0) for r in regras))
+        self.mult_valor_km  = array("d", (float(r.get("mult_valor_km", 0) or 0) for r in regras))
+        self.valor_min      = array("d", (float(r.get("valor_min", 0) or 0) for r in regras))
+        self.acrescimo_fixo = array("d", (float(r.get("acrescimo_fixo", 0) or 0) for r in regras))
+
+    def __len__(self) -> int:
+        return len(self.municipio)
+
+    def por_faixa(self, cep8: str) -> Iterator[int]:
+        """Índices das regras cuja faixa de CEP cobre cep8, na ordem da planilha."""
+        try: n = int(cep8)
+        except: return
+        for i in range(len(self.municipio)):
+            a = self.cep_ini[i]; b = self.cep_fim[i]
+            if a >= 0 and b >= 0 and a <= n <= b:
+                yield i
+
+    def por_municipio(self, cidade: str, uf: str) -> Iterator[int]:
+        """Índices das regras por nome de cidade (e UF, se informada na regra)."""
+        for i in range(len(self.municipio)):
+            muni = self.municipio[i]
+            if muni and muni == cidade and (not self.uf[i] or self.uf[i] == uf):
+                yield i
+
+    def ajusta(self, i: int, valor_km: float, km: float) -> Tuple[float, float, float]:
+        vk = valor_km
+        k  = km
+        if self.km_fixo[i] > 0: k = self.km_fixo[i]
+        if self.mult_valor_km[i] > 0: vk = float(vk) * self.mult_valor_km[i]
+        return (vk, k, self.acrescimo_fixo[i])
+
+def _cidade_uf_destino(cep8: str) -> Tuple[str, str]:
+    info = buscar_info_cep(cep8) or {}
+    return ((info.get("city") or "").strip().upper(), (info.get("uf") or "").strip().upper())
 
 def aplicar_regras_municipio(cep_destino: str, valor_km: float, km: float) -> Tuple[float, float, float]:
     cep8 = so_digitos(cep_destino)
-    info = buscar_info_cep(cep8) or {}
-    cidade = (info.get("city") or "").strip().upper()
-    uf = (info.get("uf") or "").strip().upper()
+    regras: RegrasMunicipio = DATA["regras_municipio"]
 
     # 1) Prioridade por faixa de CEP
-    for reg in DATA.get("regras_municipio", []):
-        if regra_cobre_cep(reg, cep8):
-            vk = valor_km
-            k  = km
-            if reg.get("km_fixo", 0) > 0: k = float(reg["km_fixo"])
-            if reg.get("mult_valor_km", 0) > 0: vk = float(vk) * float(reg["mult_valor_km"])
-            acres = float(reg.get("acrescimo_fixo", 0) or 0)
-            return (vk, k, acres)
+    for i in regras.por_faixa(cep8):
+        return regras.ajusta(i, valor_km, km)
 
     # 2) Cidade/UF
-    for reg in DATA.get("regras_municipio", []):
-        muni = (reg.get("municipio") or "").strip().upper()
-        uf_reg = (reg.get("uf") or "").strip().upper()
-        if muni and muni == cidade and (not uf_reg or uf_reg == uf):
-            vk = valor_km
-            k  = km
-            if reg.get("km_fixo", 0) > 0: k = float(reg["km_fixo"])
-            if reg.get("mult_valor_km", 0) > 0: vk = float(vk) * float(reg["mult_valor_km"])
-            acres = float(reg.get("acrescimo_fixo", 0) or 0)
-            return (vk, k, acres)
+    cidade, uf = _cidade_uf_destino(cep8)
+    for i in regras.por_municipio(cidade, uf):
+        return regras.ajusta(i, valor_km, km)
 
     return (valor_km, km, 0.0)
 
+def valor_min_para_destino(cep_destino: str) -> float:
+    cep8 = so_digitos(cep_destino)
+    regras: RegrasMunicipio = DATA["regras_municipio"]
+    for i in regras.por_faixa(cep8):
+        if regras.valor_min[i] > 0: return regras.valor_min[i]
+    cidade, uf = _cidade_uf_destino(cep8)
+    for i in regras.por_municipio(cidade, uf):
+        if regras.valor_min[i] > 0: return regras.valor_min[i]
+    return 0.0
+
+def _num_ou_nan(v: str) -> float:
+    try:
+        f = float(v.replace(",", "."))
+        return f if math.isfinite(f) else float("nan")
+    except: return float("nan")
+
+def carregar_depositos(xls: Optional[pd.ExcelFile]) -> List[Dict[str, Any]]:
+    """
+    Lê aba DEPOSITOS (opcional) com colunas:
+      Nome | CEP | Latitude | Longitude | Valor_KM | Tam_Caminhao
+    Preencha Latitude/Longitude: vazias são geocodificadas pelo CEP em cada worker,
+    no primeiro uso. Valor_KM e Tam_Caminhao vazios usam os valores gerais. Sem a
+    aba, o único depósito é CEP_ORIGEM (coordenadas em CEP_ORIGEM_LAT/CEP_ORIGEM_LON).
+    Não faz chamadas de rede: roda no import (no master, com --preload).
+    """
+    padrao = [{"nome": "ORIGEM", "cep": limpar_cep(CEP_ORIGEM),
+               "lat": _num_ou_nan(CEP_ORIGEM_LAT), "lon": _num_ou_nan(CEP_ORIGEM_LON)}]
+    if xls is None or "DEPOSITOS" not in xls.sheet_names:
+        return padrao
+    try:
+        # dtype=str: célula vazia numa coluna numérica faria o pandas ler CEPs como float
+        df = pd.read_excel(xls, "DEPOSITOS", dtype=str)
+        cols = {str(c).strip().lower(): c for c in df.columns}
+        def cel(r, name) -> str:
+            c = cols.get(name.lower())
+            if c is None: return ""
+            v = r.get(c)
+            return "" if v is None or pd.isna(v) else str(v).strip()
+
+        deps = []
+        for _, r in df.iterrows():
+            cep = so_digitos(cel(r, "CEP"))
+            if not cep.strip("0"): continue
+            deps.append({
+                "nome": limpar_texto(cel(r, "Nome")) or cep,
+                "cep": cep,
+                "lat": _num_ou_nan(cel(r, "Latitude")),
+                "lon": _num_ou_nan(cel(r, "Longitude")),
+                "valor_km": _num_ou_nan(cel(r, "Valor_KM")),
+                "tam_caminhao": _num_ou_nan(cel(r, "Tam_Caminhao")),
+            })
+        return deps or padrao
+    except Exception as e:
+        print(f"[WARN] Falha ao ler DEPOSITOS: {e}")
+        return padrao
+
+class Depositos:
+    """
+    Depósitos de origem em colunas numpy (um objeto por coluna), prontos p/ o
+    cálculo vetorizado de distância. valor_km/tam_caminhao = 0 usa o valor geral;
+    lat/lon NaN são completadas por coordenadas_depositos() em cada worker.
+    i_origem é o índice do depósito de CEP_ORIGEM (-1 se não houver).
+    """
+    __slots__ = ("nome", "cep", "lat", "lon", "valor_km", "tam_caminhao", "i_origem")
+
+    def __init__(self, deps: List[Dict[str, Any]]):
+        def col(chave: str, vazio: float) -> np.ndarray:
+            a = np.array([float(d.get(chave, vazio)) for d in deps], dtype=np.float64)
+            a[np.isnan(a)] = vazio
+            return a
+        self.nome: Tuple[str, ...] = tuple(d["nome"] for d in deps)
+        self.cep: Tuple[str, ...]  = tuple(d["cep"] for d in deps)
+        self.lat = col("lat", np.nan)
+        self.lon = col("lon", np.nan)
+        self.valor_km = col("valor_km", 0.0)
+        self.tam_caminhao = col("tam_caminhao", 0.0)
+        for a in (self.lat, self.lon, self.valor_km, self.tam_caminhao):
+            a.flags.writeable = False
+        origem = limpar_cep(CEP_ORIGEM)
+        self.i_origem = self.cep.index(origem) if origem in self.cep else -1
+
+    def __len__(self) -> int:
+        return len(self.cep)
+
 # ==========================
 # CARREGAMENTO GERAL
 # ==========================
 def carregar_tudo() -> Dict[str, Any]:
+    """
+    Lê a planilha e devolve só estruturas compactas (sem DataFrames vivos).
+    Com `gunicorn --preload` roda uma única vez no master, antes do fork.
+    """
     try:
         xls = pd.ExcelFile(ARQ_PLANILHA)
     except Exception as e:
         print(f"[WARN] Não foi possível carregar planilha: {e}")
         return {
             "consts": {"VALOR_KM": DEFAULT_VALOR_KM, "TAM_CAMINHAO": DEFAULT_TAM_CAMINHAO},
-            "catalogo": {},
-            "regras_municipio": []
+            "catalogo": Catalogo({}),
+            "regras_municipio": RegrasMunicipio([]),
+            "depositos": Depositos(carregar_depositos(None))
         }
 
     consts = carregar_constantes(xls)
     cadastro = carregar_cadastro_produtos(xls)
-    catalogo = montar_catalogo_tamanho(cadastro)
-    regras_mun = carregar_regras_municipio(xls)
+    catalogo = Catalogo(montar_catalogo_tamanho(cadastro))
+    regras_mun = RegrasMunicipio(carregar_regras_municipio(xls))
+    depositos = Depositos(carregar_depositos(xls))
+    xls.close()
 
     return {
         "consts": consts,
         "catalogo": catalogo,
-        "regras_municipio": regras_mun
+        "regras_municipio": regras_mun,
+        "depositos": depositos
     }
 
 DATA = carregar_tudo()
+DATA_PID = os.getpid()  # processo que carregou a planilha (master, se --preload)
+
+# Move tudo que já existe p/ a geração permanente: o GC dos workers não
+# varre (nem suja) as páginas herdadas do master.
+gc.collect()
+gc.freeze()
 
 # ==========================
 # CÁLCULO DE FRETE
@@ -461,46 +764,67 @@ def calcula_valor_item(tamanho_peca_m: float, km: float, valor_km: float, tam_ca
     ocupacao = float(tamanho_peca_m) / float(tam_caminhao)
     return round(float(valor_km) * float(km) * ocupacao, 2)
 
-def parse_prods(prods_str: str) -> List[Dict[str, Any]]:
-    itens: List[Dict[str, Any]] = []
-    if not prods_str: return itens
-
-    blocos = []
-    for sep in ("/", "|"):
-        if sep in prods_str:
-            blocos = [b for b in prods_str.split(sep) if b.strip()]
-            break
-    if not blocos: blocos = [prods_str]
-
-    def norm_num(x):
-        if x is None: return 0.0
-        s = str(x).strip().lower()
-        if s in ("", "null", "none", "nan"): return 0.0
-        s = s.replace(",", ".")
-        try: return float(s)
-        except: return 0.0
+class ItemProd:
+    """Linha do carrinho já normalizada (dimensões em metros)."""
+    __slots__ = ("comp", "larg", "alt", "cub", "qty", "peso", "codigo", "valor")
+
+    def __init__(self, comp: float, larg: float, alt: float, cub: float,
+                 qty: int, peso: float, codigo: str, valor: float):
+        self.comp = comp; self.larg = larg; self.alt = alt; self.cub = cub
+        self.qty = qty; self.peso = peso; self.codigo = codigo; self.valor = valor
+
+_NULOS = frozenset(("", "null", "none", "nan"))
+
+def _norm_num(x: str) -> float:
+    s = x.strip().lower()
+    if s in _NULOS: return 0.0
+    try: return float(s.replace(",", "."))
+    except: return 0.0
+
+def _cm_to_m(x: float) -> float:
+    if not x: return 0.0
+    return x/100.0 if x > 20 else x
+
+def parse_prods(prods_str: str, limite: int = MAX_PRODS_CHARS) -> List[ItemProd]:
+    """
+    Formato Tray: comp;larg;alt;cub;qty;peso;codigo;valor, itens separados por '/' ou '|'.
+    Uma passada por item (cada campo normalizado uma vez). Linhas com o mesmo
+    `codigo` e as mesmas dimensões são fundidas somando quantidade, peso e valor.
+    Entradas maiores que `limite` levantam ValueError.
+    """
+    if not prods_str: return []
+    if limite and len(prods_str) > limite:
+        raise ValueError(f"Parâmetro prods excede {limite} caracteres")
 
-    def cm_to_m(x):
-        if not x or x == 0: return 0.0
-        return x/100.0 if x > 20 else x
+    sep = "/" if "/" in prods_str else ("|" if "|" in prods_str else None)
+    blocos = prods_str.split(sep) if sep else (prods_str,)
 
+    itens: List[ItemProd] = []
+    por_chave: Dict[Tuple[str, float, float, float], ItemProd] = {}
     for raw in blocos:
+        if not raw.strip(): continue
         try:
-            partes = raw.split(";")
-            while len(partes) < 8:
-                partes.append("0")
-            comp, larg, alt, cub, qty, peso, codigo, valor = partes[:8]
-            item = {
-                "comp": cm_to_m(norm_num(comp)),
-                "larg": cm_to_m(norm_num(larg)),
-                "alt": cm_to_m(norm_num(alt)),
-                "cub": norm_num(cub),
-                "qty": int(norm_num(qty)) if norm_num(qty) > 0 else 1,
-                "peso": norm_num(peso),
-                "codigo": (codigo or "").strip(),
-                "valor": norm_num(valor),
-            }
+            partes = raw.split(";", 8)
+            n = len(partes)
+            comp = _norm_num(partes[0])
+            larg = _norm_num(partes[1]) if n > 1 else 0.0
+            alt  = _norm_num(partes[2]) if n > 2 else 0.0
+            cub  = _norm_num(partes[3]) if n > 3 else 0.0
+            q    = _norm_num(partes[4]) if n > 4 else 0.0
+            peso = _norm_num(partes[5]) if n > 5 else 0.0
+            codigo = partes[6].strip() if n > 6 else ""
+            valor  = _norm_num(partes[7]) if n > 7 else 0.0
+            qty = max(1, int(q))  # mesma regra do frete(), antes de somar na fusão
+
+            comp, larg, alt = _cm_to_m(comp), _cm_to_m(larg), _cm_to_m(alt)
+            chave = (codigo, comp, larg, alt)
+            ja = por_chave.get(chave) if codigo else None
+            if ja is not None:
+                ja.qty += qty; ja.peso += peso; ja.valor += valor
+                continue
+            item = ItemProd(comp, larg, alt, cub, qty, peso, codigo, valor)
             itens.append(item)
+            if codigo: por_chave[chave] = item
         except Exception as e:
             print(f"[WARN] Erro parse item: {raw} - {e}")
             continue
@@ -509,8 +833,13 @@ def parse_prods(prods_str: str) -> List[Dict[str, Any]]:
 # ==========================
 # RESPOSTA XML
 # ==========================
-def _monta_xml_ok(total: float, itens_xml: List[str], debug_info: str) -> str:
-    return f"""<?xml version="1.0" encoding="UTF-8"?>
+def _gera_xml_ok(total: float, itens: List[ItemProd], tams: array, v_units: array,
+                 km: float, debug_info: str) -> Iterator[str]:
+    """
+    Gera a resposta de cotação em pedaços de ~XML_CHUNK_BYTES p/ envio em streaming
+    (um write por pedaço, não por item).
+    """
+    buf = [f"""<?xml version="1.0" encoding="UTF-8"?>
 <cotacao>
   <resultado>
     <codigo>BAKOF</codigo>
@@ -521,11 +850,30 @@ def _monta_xml_ok(total: float, itens_xml: List[str], debug_info: str) -> str:
     <prazo_min>4</prazo_min>
     <prazo_max>7</prazo_max>
     <entrega_domiciliar>1</entrega_domiciliar>
-    <detalhes>{"".join(itens_xml)}
+    <detalhes>"""]
+    tam_buf = len(buf[0])
+    for i, it in enumerate(itens):
+        v_unit = v_units[i]
+        parte = f"""
+      <item>
+        <codigo>{html.escape(it.codigo or "Item")}</codigo>
+        <quantidade>{it.qty}</quantidade>
+        <diametro_metros>{tams[i]:.3f}</diametro_metros>
+        <km_distancia>{km:.1f}</km_distancia>
+        <valor_unitario>{v_unit:.2f}</valor_unitario>
+        <valor_total>{v_unit * max(1, it.qty):.2f}</valor_total>
+      </item>"""
+        buf.append(parte)
+        tam_buf += len(parte)
+        if tam_buf >= XML_CHUNK_BYTES:
+            yield "".join(buf)
+            buf = []; tam_buf = 0
+    buf.append(f"""
     </detalhes>
     {debug_info}
   </resultado>
-</cotacao>""".strip()
+</cotacao>""")
+    yield "".join(buf)
 
 def _monta_xml_erro(msg: str) -> str:
     msg = html.escape(msg or "Erro")
@@ -540,9 +888,21 @@ def _resp_xml(xml: str, status: int = 200) -> Response:
     resp.headers["Access-Control-Allow-Origin"] = "*"
     return resp
 
+def _resp_xml_stream(partes: Iterator[str], status: int = 200) -> Response:
+    resp = Response(partes, status=status)
+    resp.headers["Content-Type"] = "application/xml; charset=utf-8"
+    resp.headers["Access-Control-Allow-Origin"] = "*"
+    return resp
+
 # ==========================
 # ENDPOINTS
 # ==========================
+def _param_positivo(nome: str) -> Optional[float]:
+    try:
+        v = float(str(request.args.get(nome, "")).replace(",", "."))
+    except: return None
+    return v if math.isfinite(v) and v > 0 else None
+
 @app.route("/health")
 def health():
     return {
@@ -551,7 +911,12 @@ def health():
         "valores": DATA["consts"],
         "itens_catalogo": len(DATA["catalogo"]),
         "regras_municipio": len(DATA.get("regras_municipio", [])),
+        "depositos": [{"nome": n, "cep": c} for n, c in zip(DATA["depositos"].nome, DATA["depositos"].cep)],
+        "deposito_criterio": DEPOSITO_CRITERIO,
         "cache_coordenadas": len(cache_coords),
+        "pid": os.getpid(),
+        "preload": os.getpid() != DATA_PID,
+        "memoria_kb": memoria_processo(),
     }
 
 @app.route("/frete")
@@ -561,28 +926,46 @@ def frete():
     if token != TOKEN_SECRETO:
         return _resp_xml(_monta_xml_erro("Token inválido"), status=403)
 
-    cep_origem_param = request.args.get("cep_origem", CEP_ORIGEM)
+    cep_origem_param = request.args.get("cep_origem", "")
     cep_destino = request.args.get("cep_destino", "")
     prods = request.args.get("prods", "")
 
     if not cep_destino or not prods:
         return _resp_xml(_monta_xml_erro("Parâmetros insuficientes (cep_destino, prods)"), status=400)
 
-    itens = parse_prods(prods)
+    try:
+        itens = parse_prods(prods)
+    except ValueError as e:
+        return _resp_xml(_monta_xml_erro(str(e)), status=414)
     if not itens:
         return _resp_xml(_monta_xml_erro("Nenhum item válido em 'prods'"), status=400)
 
     valor_km = DATA["consts"].get("VALOR_KM", DEFAULT_VALOR_KM)
     tam_caminhao = DATA["consts"].get("TAM_CAMINHAO", DEFAULT_TAM_CAMINHAO)
 
-    try:
-        if request.args.get("valor_km"):
-            valor_km = float(str(request.args["valor_km"]).replace(",", "."))
-        if request.args.get("tam_caminhao"):
-            tam_caminhao = float(str(request.args["tam_caminhao"]).replace(",", "."))
-    except: pass
+    # Overrides só valem se finitos e > 0 (nan/negativos quebrariam a escolha do depósito)
+    valor_km_param = _param_positivo("valor_km")
+    tam_caminhao_param = _param_positivo("tam_caminhao")
+
+    # Origem: cep_origem explícito ou o melhor depósito p/ o destino
+    deposito = "param"
+    if cep_origem_param:
+        km, km_fonte = calcular_distancia_ceps(cep_origem_param, cep_destino)
+    else:
+        deps: Depositos = DATA["depositos"]
+        i_dep, km, km_fonte = distancia_por_deposito(cep_destino, valor_km_param, tam_caminhao_param)
+        if i_dep is not None:
+            deposito = deps.nome[i_dep]
+            cep_origem_param = deps.cep[i_dep]
+            if deps.valor_km[i_dep] > 0: valor_km = float(deps.valor_km[i_dep])
+            if deps.tam_caminhao[i_dep] > 0: tam_caminhao = float(deps.tam_caminhao[i_dep])
+        else:
+            deposito = "ORIGEM"
+            cep_origem_param = CEP_ORIGEM
+
+    if valor_km_param is not None: valor_km = valor_km_param
+    if tam_caminhao_param is not None: tam_caminhao = tam_caminhao_param
 
-    km, km_fonte = calcular_distancia_ceps(cep_origem_param, cep_destino)
     if km is None:
         uf_dest = uf_por_cep(so_digitos(cep_destino))
         KM_APROX_POR_UF = {
@@ -597,52 +980,30 @@ def frete():
     valor_km_aplic, km_aplic, acrescimo_fixo = aplicar_regras_municipio(cep_destino, valor_km, km)
 
     total = 0.0
-    itens_xml = []
+    tams = array("d")
+    v_units = array("d")
+    catalogo = DATA["catalogo"]
     for it in itens:
-        codigo = it["codigo"] or "Item"
-        tam_catalogo = DATA["catalogo"].get(codigo)
+        codigo = it.codigo or "Item"
+        tam_catalogo = catalogo.get(codigo)
         if tam_catalogo is None:
-            tam_catalogo = tamanho_peca_por_nome(codigo, it["alt"], it["larg"])
+            tam_catalogo = tamanho_peca_por_nome(codigo, it.alt, it.larg)
             if tam_catalogo == 0:
-                tam_catalogo = max(it["comp"], it["larg"], it["alt"])
+                tam_catalogo = max(it.comp, it.larg, it.alt)
 
         v_unit = calcula_valor_item(tam_catalogo, km_aplic, valor_km_aplic, tam_caminhao)
-        v_tot  = v_unit * max(1, it["qty"])
-        total += v_tot
-
-        itens_xml.append(f"""
-      <item>
-        <codigo>{html.escape(codigo)}</codigo>
-        <quantidade>{it['qty']}</quantidade>
-        <diametro_metros>{tam_catalogo:.3f}</diametro_metros>
-        <km_distancia>{km_aplic:.1f}</km_distancia>
-        <valor_unitario>{v_unit:.2f}</valor_unitario>
-        <valor_total>{v_tot:.2f}</valor_total>
-      </item>""")
+        total += v_unit * max(1, it.qty)
+        tams.append(tam_catalogo)
+        v_units.append(v_unit)
 
     total += acrescimo_fixo
 
-    def _valor_min_para_destino(cep):
-        cep8 = so_digitos(cep)
-        info = buscar_info_cep(cep8) or {}
-        cidade = (info.get("city") or "").strip().upper()
-        uf = (info.get("uf") or "").strip().upper()
-        for reg in DATA.get("regras_municipio", []):
-            if regra_cobre_cep(reg, cep8) and float(reg.get("valor_min", 0) or 0) > 0:
-                return float(reg["valor_min"])
-        for reg in DATA.get("regras_municipio", []):
-            muni = (reg.get("municipio") or "").strip().upper()
-            uf_reg = (reg.get("uf") or "").strip().upper()
-            if muni and muni == cidade and (not uf_reg or uf_reg == uf):
-                vm = float(reg.get("valor_min", 0) or 0)
-                if vm > 0: return vm
-        return 0.0
-
-    valor_min = _valor_min_para_destino(cep_destino)
+    valor_min = valor_min_para_destino(cep_destino)
     if valor_min > 0 and total < valor_min:
         total = float(valor_min)
 
     debug_info = (f"<debug "
+                  f"deposito='{html.escape(deposito)}' "
                   f"cep_origem='{html.escape(cep_origem_param)}' "
                   f"cep_destino='{html.escape(cep_destino)}' "
                   f"km='{km_aplic:.1f}' "
@@ -653,22 +1014,28 @@ def frete():
                   f"valor_min='{valor_min:.2f}' "
                   f"total_itens='{len(itens)}'/>")
 
-    xml = _monta_xml_ok(total, itens_xml, debug_info)
-    return _resp_xml(xml, status=200)
+    return _resp_xml_stream(_gera_xml_ok(total, itens, tams, v_units, km_aplic, debug_info))
 
 @app.route("/teste-distancia")
 def teste_distancia():
-    cep_origem = request.args.get("origem", CEP_ORIGEM)
+    cep_origem = request.args.get("origem", "")
     cep_destino = request.args.get("destino", "")
     if not cep_destino:
         return {"erro": "Informe o parâmetro 'destino'"}
 
-    km, fonte = calcular_distancia_ceps(cep_origem, cep_destino)
+    deposito = "param"
+    if cep_origem:
+        km, fonte = calcular_distancia_ceps(cep_origem, cep_destino)
+    else:
+        i_dep, km, fonte = distancia_por_deposito(cep_destino)
+        deposito = DATA["depositos"].nome[i_dep] if i_dep is not None else "ORIGEM"
+        cep_origem = DATA["depositos"].cep[i_dep] if i_dep is not None else CEP_ORIGEM
     coord_origem = buscar_coordenadas(cep_origem)
     coord_destino = buscar_coordenadas(cep_destino)
     info_dest = buscar_info_cep(cep_destino) or {}
 
     return {
+        "deposito": deposito,
         "cep_origem": cep_origem,
         "cep_destino": cep_destino,
         "coordenadas_origem": coord_origem,
@@ -707,4 +1074,5 @@ if __name__ == "__main__":
     print(f"🔑 Token: {TOKEN_SECRETO}")
     print(f"📊 Produtos no catálogo: {len(DATA['catalogo'])}")
     print(f"🧭 Regras de município: {len(DATA.get('regras_municipio', []))}")
+    print(f"🏭 Depósitos: {len(DATA['depositos'])} (critério: {DEPOSITO_CRITERIO})")
     app.run(host="0.0.0.0", port=port, debug=True)